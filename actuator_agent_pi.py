@@ -1,6 +1,9 @@
 # actuator_agent_pi.py
 import socket
-import json
+import selectors
+import struct
+import msgspec
+from typing import Optional, Tuple
 import time
 import threading
 from gpsdclient import GPSDClient
@@ -12,12 +15,98 @@ import adafruit_mcp4725
 LAPTOP_IP = "0.0.0.0"  # <--- IMPORTANT: SET YOUR LAPTOP's IP
 LAPTOP_PORT = 65431
 AGENT_ID = "actuator_pi"
+GPS_MIN_CHANGE_DEG = 1e-6 # Smaller lat/lon movements are not republished
 V_REF = 3.3
+V_REF_SCALE = 65535 / V_REF # Volts -> 16-bit DAC code
+COMMAND_WAIT_TIMEOUT = 5.0 # Seconds per select() wait, so the loop never blocks forever in recv
+SOCKET_READ_BUFFER = 65536
 
 # --- Global State ---
 latest_gps_coords = None
 dac = None
 
+# --- Wire Messages (must match the definitions in control_center_laptop.py) ---
+class ActuatorCommand(msgspec.Struct):
+    voltage: float
+    status: str
+    seq: int
+
+class ActuatorStatus(msgspec.Struct):
+    t2: float
+    t3: float
+    voltage_set: float
+    seq: Optional[int] = None
+    gps: Optional[Tuple[float, float]] = None
+    t2_mono: Optional[int] = None
+    t3_mono: Optional[int] = None
+
+# --- GPSD Reports ---
+class Tpv(msgspec.Struct): # Only the fields we read; the rest of each gpsd report is skipped while decoding
+    class_: str = msgspec.field(default='', name='class')
+    mode: int = 0
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+tpv_decoder = msgspec.json.Decoder(Tpv)
+
+# --- Socket Tuning (same settings as control_center_laptop.py) ---
+SOCKET_BUFFER_BYTES = 64 * 1024
+KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_PROBES = 5, 2, 3
+SOCKET_TIMEOUT = 10 # Seconds before a blocking socket call gives up
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, option): sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+
+# --- Message Framing (length prefix + MessagePack, as in control_center_laptop.py) ---
+msg_encoder = msgspec.msgpack.Encoder()
+command_decoder = msgspec.msgpack.Decoder(ActuatorCommand)
+
+def frame_msg(obj):
+    payload = msg_encoder.encode(obj)
+    return struct.pack('!I', len(payload)) + payload
+
+def send_msg(sock, obj):
+    sock.sendall(frame_msg(obj))
+
+class FrameReader:
+    """Incremental reader over one reusable bytearray; see control_center_laptop.py for the full notes."""
+    def __init__(self, sock, size=SOCKET_READ_BUFFER):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+
+    def next_frame(self):
+        if self.end - self.start < 4: return None
+        (length,) = struct.unpack_from('!I', self.buf, self.start)
+        if self.end - self.start < 4 + length: return None
+        frame = self.view[self.start + 4:self.start + 4 + length]
+        self.start += 4 + length
+        return frame
+
+    def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            pending = self.end - self.start
+            if self.start: self.buf[:pending] = self.buf[self.start:self.end]
+            else:
+                grown = bytearray(2 * len(self.buf)); grown[:pending] = self.buf
+                self.buf, self.view = grown, memoryview(grown)
+            self.start, self.end = 0, pending
+        n = self.sock.recv_into(self.view[self.end:])
+        if TCP_QUICKACK is not None: self.sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+        self.end += n
+        return n > 0
+
+INTRO_BYTES = frame_msg({'id': AGENT_ID}) # Identical on every reconnect, so framed once
+
 def setup_dac():
     global dac
     try:
@@ -41,31 +130,35 @@ def control_vehicle(voltage, status):
         return 0.0
     
     if status == "Proper":
-        output_value = int((voltage / V_REF) * 65535)
-        dac.value = max(0, min(65535, output_value))
+        output_value = int(voltage * V_REF_SCALE)
+        dac.value = 0 if output_value < 0 else 65535 if output_value > 65535 else output_value
         return voltage
     else:
         dac.value = 0
         return 0.0
 
-def get_gps_coords():
-    try:
-        with GPSDClient() as client:
-            for result_str in client.json_stream():
-                result = json.loads(result_str)
-                if result.get("class") == "TPV" and result.get("mode") == 3 and "lat" in result:
-                    coords = (result['lat'], result['lon'])
-                    print(f"🛰  Actuator Pi GPS Lock: {coords}")
-                    return coords
-    except Exception as e:
-        print(f"❌ GPSD Error on Actuator Pi: {e}")
-        return None
-
 def gps_polling_thread():
+    # Keeps one gpsd connection open and only publishes a fix when the position actually moves
     global latest_gps_coords
     while True:
-        latest_gps_coords = get_gps_coords()
-        time.sleep(3)
+        try:
+            with GPSDClient() as client:
+                last_raw_str = None
+                for result_str in client.json_stream():
+                    if result_str == last_raw_str: continue # Identical report, nothing new to parse
+                    last_raw_str = result_str
+                    try: tpv = tpv_decoder.decode(result_str)
+                    except msgspec.DecodeError: continue # A report whose fields don't fit Tpv isn't a fix
+                    if tpv.class_ == "TPV" and tpv.mode == 3 and tpv.lat is not None and tpv.lon is not None:
+                        coords = (tpv.lat, tpv.lon)
+                        if (latest_gps_coords is None or abs(coords[0] - latest_gps_coords[0]) > GPS_MIN_CHANGE_DEG
+                                or abs(coords[1] - latest_gps_coords[1]) > GPS_MIN_CHANGE_DEG):
+                            latest_gps_coords = coords
+                            print(f"🛰  Actuator Pi GPS Lock: {coords}")
+        except Exception as e:
+            print(f"❌ GPSD Error on Actuator Pi: {e}")
+            latest_gps_coords = None
+        time.sleep(3) # Back off before reconnecting to gpsd
 
 def main():
     print(f"--- Starting Actuator Agent ({AGENT_ID}) ---")
@@ -75,36 +168,44 @@ def main():
     while True:
         try:
             print(f"Attempting to connect to Control Center at {LAPTOP_IP}:{LAPTOP_PORT}...")
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, selectors.DefaultSelector() as sel:
+                tune_socket(s)
+                s.settimeout(SOCKET_TIMEOUT) # A stalled connect/send/recv raises instead of hanging
                 s.connect((LAPTOP_IP, LAPTOP_PORT))
                 print("✅ Connected to Control Center.")
                 
-                intro_message = json.dumps({'id': AGENT_ID}).encode('utf-8')
-                s.sendall(intro_message)
-                
+                s.sendall(INTRO_BYTES)
+                sel.register(s, selectors.EVENT_READ)
+                reader = FrameReader(s)
                 while True:
-                    command_data = s.recv(1024)
-                    if not command_data: break
+                    frame = reader.next_frame()
+                    if frame is None:
+                        # Only wait on the socket once every buffered command has been handled
+                        if not sel.select(timeout=COMMAND_WAIT_TIMEOUT): continue
+                        if not reader.fill(): break
+                        continue
                     
                     # <<< MODIFICATION START >>>
-                    t2_actuator = time.time() # Time of receipt
-                    
-                    command = json.loads(command_data.decode('utf-8'))
-                    voltage_set = control_vehicle(command['voltage'], command['status'])
-                    
-                    t3_actuator = time.time() # Time after action
-                    
+                    t2_actuator, t2_mono = time.time(), time.monotonic_ns() # Time of receipt
+                    command = command_decoder.decode(frame)
+                
+                    voltage_set = control_vehicle(command.voltage, command.status)
+                
+                    t3_actuator, t3_mono = time.time(), time.monotonic_ns() # Time after action
+                
                     # New report packet with detailed timestamps
-                    report_back = {
-                        'type': 'actuator_status',
-                        't2': t2_actuator,
-                        't3': t3_actuator,
-                        'gps': latest_gps_coords,
-                        'voltage_set': voltage_set
-                    }
+                    report_back = ActuatorStatus(
+                        t2=t2_actuator,
+                        t3=t3_actuator,
+                        t2_mono=t2_mono,
+                        t3_mono=t3_mono,
+                        gps=latest_gps_coords,
+                        voltage_set=voltage_set,
+                        seq=command.seq
+                    )
                     # <<< MODIFICATION END >>>
-                    
-                    s.sendall(json.dumps(report_back).encode('utf-8'))
+                
+                    send_msg(s, report_back)
 
         except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError) as e:
             print(f"❌ Connection lost: {e}. Retrying in 5 seconds...")
@@ -2,17 +2,26 @@
 import tkinter as tk
 from tkinter import messagebox
 import socket
-import json
+import selectors
+import struct
+import msgspec
+from typing import Optional, Tuple
 import threading
+import queue
+import multiprocessing
 import time
 import gspread
-import statistics
+from requests.adapters import HTTPAdapter
+import math
 from datetime import datetime
 from PIL import Image, ImageTk
 import cv2
+import numpy as np
 from flask import Flask, render_template_string
+from waitress import serve
 import folium
-import collections
+import itertools
+import functools
 
 # --- Configuration ---
 SERVICE_ACCOUNT_FILE = 'credentials.json'
@@ -20,12 +29,129 @@ GOOGLE_SHEET_NAME = 'Pi transaction log'
 LAPTOP_IP = '0.0.0.0'
 SENSOR_AGENT_PORT = 65430
 ACTUATOR_AGENT_PORT = 65431
+ACTUATOR_RESPONSE_TIMEOUT = 2.0 # Seconds a forwarded command waits for the actuator's status
+SELECT_TIMEOUT = 0.1 # Network loop wakeup period for expiring unanswered commands
 FRAME_WIDTH, FRAME_HEIGHT = 640, 480
+CAMERA_FPS = 30
+CAMERA_RETRY_DELAY = 0.1 # Back-off after a failed grab, so a missing camera doesn't spin the thread
+CAMERA_MAX_FAILED_GRABS = 50 # Consecutive failed grabs (~5 s) before the camera is treated as gone and released
+FLASK_THREADS = 4
+MAP_CACHE_SIZE = 64 # Rendered map pages kept, keyed by the rounded GPS pair
+VIDEO_REFRESH_MS = 33 # update_video_feed period; capture_camera only decodes frames at this cadence
+SHEET_FLUSH_INTERVAL = 5 # Max seconds a logged row waits before being written to the sheet
+SHEET_BATCH_ROWS = 500 # Max rows per append_rows call
+SHEET_QUEUE_MAX = 5000 # Bound on rows waiting for the sheet writer
+SHEET_WRITER_JOIN_TIMEOUT = 30 # Seconds stop_session waits for the final sheet write
+LOG_HEADER = ["Packet #", "Pi1 Send Time", "Corrected Pi2 Receive Time", "Delay (ms)", "ADC Sensor Voltage", "Data Status", "DAC Voltage Set (V)", "Sensor Pi GPS"]
+SOCKET_READ_BUFFER = 65536
+# Status label (text, colour) keyed by whether the Pi is connected
+SENSOR_LABELS = {True: ("Sensor Pi: Connected", "green"), False: ("Sensor Pi: Disconnected", "red")}
+ACTUATOR_LABELS = {True: ("Actuator Pi: Connected", "green"), False: ("Actuator Pi: Disconnected", "red")}
 
+# --- Wire Messages (must match the definitions in the agent scripts) ---
+class SensorPacket(msgspec.Struct, array_like=True): # Fixed schema: sent as a positional array, no field names on the wire
+    voltage: float
+    status: str
+    gps: Optional[Tuple[float, float]]
+    timestamp: float
+
+class ActuatorCommand(msgspec.Struct):
+    voltage: float
+    status: str
+    seq: int
+
+class ActuatorStatus(msgspec.Struct):
+    t2: float
+    t3: float
+    voltage_set: float
+    seq: Optional[int] = None
+    gps: Optional[Tuple[float, float]] = None
+    t2_mono: Optional[int] = None
+    t3_mono: Optional[int] = None
+
+# --- Socket Tuning ---
+SOCKET_BUFFER_BYTES = 64 * 1024 # Fixed kernel buffers; the packets are tiny, so autotuning buys nothing
+KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_PROBES = 5, 2, 3 # A silent peer is declared dead after ~11 s
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None) # Linux only
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Send small packets immediately (no Nagle delay)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, option): sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value) # Platform-dependent
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+
+# --- Message Framing ---
+# Every message is a 4-byte big-endian length prefix followed by a MessagePack payload.
+# Encoders/decoders are built once and reused for every message.
+msg_encoder = msgspec.msgpack.Encoder()
+any_decoder = msgspec.msgpack.Decoder() # Intro messages
+sensor_decoder = msgspec.msgpack.Decoder(SensorPacket)
+status_decoder = msgspec.msgpack.Decoder(ActuatorStatus)
+
+def send_msg(sock, obj):
+    payload = msg_encoder.encode(obj)
+    sock.sendall(struct.pack('!I', len(payload)) + payload)
+
+class FrameReader:
+    """Reassembles length-prefixed frames from a socket into one reusable bytearray via recv_into."""
+    def __init__(self, sock, size=SOCKET_READ_BUFFER):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0 # Unconsumed bytes are buf[start:end]
+
+    def next_frame(self):
+        """Returns the next buffered payload as a memoryview (valid until the next fill), or None if incomplete."""
+        if self.end - self.start < 4: return None
+        (length,) = struct.unpack_from('!I', self.buf, self.start)
+        if self.end - self.start < 4 + length: return None
+        frame = self.view[self.start + 4:self.start + 4 + length]
+        self.start += 4 + length
+        return frame
+
+    def fill(self):
+        """Performs one recv_into after the buffered bytes; returns False once the peer has closed."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            pending = self.end - self.start
+            if self.start: # Move the partial frame to the front
+                self.buf[:pending] = self.buf[self.start:self.end]
+            else: # A single frame fills the buffer, so grow it
+                grown = bytearray(2 * len(self.buf)); grown[:pending] = self.buf
+                self.buf, self.view = grown, memoryview(grown)
+            self.start, self.end = 0, pending
+        n = self.sock.recv_into(self.view[self.end:])
+        if TCP_QUICKACK is not None: # The kernel clears QUICKACK after each ACK, so re-arm it on every read
+            self.sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+        self.end += n
+        return n > 0
+
+def _format_clock(ts):
+    # HH:MM:SS:ffffff without building a datetime per timestamp
+    return time.strftime('%H:%M:%S', time.localtime(ts)) + f":{int((ts % 1) * 1e6):06d}"
+
+def format_log_row(row):
+    packet_num, t1, corrected_t2_sec, true_latency_sec, adc_voltage, status, dac_voltage_set, gps = row
+    return [
+        packet_num,
+        _format_clock(t1),
+        _format_clock(corrected_t2_sec),
+        f"{true_latency_sec * 1000:.2f}",
+        f"{adc_voltage:.4f}" if status == "Proper" else "Junk Value",
+        status,
+        f"{dac_voltage_set:.4f}V" if isinstance(dac_voltage_set, float) else "N/A",
+        f"{gps[0]:.5f},{gps[1]:.5f}" if gps else ""
+    ]
+
+# The Flask map server runs in its own process (see run_flask); GPS fixes reach it through a Manager dict
 app = Flask(__name__)
+shared_gps = None
 
 class ControlCenterApp:
-    def __init__(self, master):
+    def __init__(self, master, gps_data):
         self.master = master
         self.master.title("Control Center Dashboard")
 
@@ -34,16 +160,29 @@ class ControlCenterApp:
         self.sensor_addr, self.actuator_addr = None, None
         self.worksheet = None
         self.stop_threads = threading.Event()
+        self._prev_labels = {'sensor': None, 'actuator': None, 'start': None} # Last options applied per widget
+        self._status_dirty = False # A flush_status call is already scheduled
         self.is_session_active = False
-        self.last_frame = None
-        self.clients_lock = threading.Lock()
-        self.gps_data = {"sensor_pi": None, "actuator_pi": None}
-        self.log_data = []
-        self.latencies_ms = []
+        # Lock-free double-buffered BGR frames (one producer, one consumer): capture_camera fills the back buffer,
+        # flips _front, then bumps _frame_gen; update_video_feed draws the front buffer when the generation changes
+        self._frame_bufs = [bytearray(FRAME_WIDTH * FRAME_HEIGHT * 3) for _ in range(2)]
+        self._frame_views = [np.frombuffer(buf, np.uint8).reshape(FRAME_HEIGHT, FRAME_WIDTH, 3) for buf in self._frame_bufs]
+        self._front = 0
+        self._frame_counter = itertools.count(1)
+        self._frame_gen = self._drawn_gen = 0
+        self._pil_img = Image.new('RGB', (FRAME_WIDTH, FRAME_HEIGHT)) # Reused; BGR->RGB happens while loading it
+        self.gps_data = gps_data # Manager dict shared with the Flask process
+        self._lat_n, self._lat_mean, self._lat_m2 = 0, 0.0, 0.0 # Welford running latency stats (ms)
+        # handle_actuator_status only queues rows; each session's sheet_writer_loop owns the sheet writes
+        self.sheet_queue = None
+        self._sheet_writer = None
+        self._packet_count = 0
+        self._dropped_rows = 0 # Rows the full sheet queue could not take
         
-        # <<< MODIFICATION: Added thread-safe queue for actuator responses >>>
-        self.response_queue = collections.deque()
-        self.queue_lock = threading.Lock()
+        # <<< MODIFICATION: Pending actuator responses keyed by command sequence number (the UI thread clears it) >>>
+        self.pending = {}  # seq -> (sensor packet, monotonic deadline)
+        self.pending_lock = threading.Lock()
+        self.next_seq = itertools.count()
 
         # --- GUI Layout (Same as before) ---
         main_frame = tk.Frame(master)
@@ -52,6 +191,8 @@ class ControlCenterApp:
         video_frame.pack(side="left", fill="both", expand=True, padx=10, pady=10)
         self.video_label = tk.Label(video_frame)
         self.video_label.pack()
+        self._photo = ImageTk.PhotoImage(image=self._pil_img)
+        self.video_label.config(image=self._photo)
         control_frame = tk.Frame(main_frame, width=300)
         control_frame.pack(side="right", fill="y", padx=10, pady=10)
         control_frame.pack_propagate(False)
@@ -71,8 +212,6 @@ class ControlCenterApp:
         self.setup_google_sheets()
         threading.Thread(target=self.capture_camera, daemon=True).start()
         threading.Thread(target=self.run_network_server, daemon=True).start()
-        threading.Thread(target=lambda: app.run(host='0.0.0.0', port=5000), daemon=True).start()
-        app.config['CONTROL_CENTER_INSTANCE'] = self
         self.update_video_feed()
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
 
@@ -82,23 +221,37 @@ class ControlCenterApp:
             self.stop_threads.set()
             self.master.destroy()
 
+    def request_status_update(self):
+        # Called from network threads; bursts of connect/disconnect events collapse into one idle-time refresh
+        if not self._status_dirty:
+            self._status_dirty = True
+            self.master.after_idle(self.flush_status)
+
+    def flush_status(self):
+        self._status_dirty = False
+        self.update_status_labels()
+
     def update_status_labels(self):
-        # (Same as before)
-        if self.sensor_conn: self.sensor_status_label.config(text="Sensor Pi: Connected", fg="green")
-        else: self.sensor_status_label.config(text="Sensor Pi: Disconnected", fg="red")
-        if self.actuator_conn: self.actuator_status_label.config(text="Actuator Pi: Connected", fg="green")
-        else: self.actuator_status_label.config(text="Actuator Pi: Disconnected", fg="red")
-        if self.sensor_conn and self.actuator_conn: self.start_button.config(state=tk.NORMAL)
-        else: self.start_button.config(state=tk.DISABLED)
+        text, fg = SENSOR_LABELS[bool(self.sensor_conn)]; self.config_if_changed('sensor', self.sensor_status_label, text=text, fg=fg)
+        text, fg = ACTUATOR_LABELS[bool(self.actuator_conn)]; self.config_if_changed('actuator', self.actuator_status_label, text=text, fg=fg)
+        self.config_if_changed('start', self.start_button, state=tk.NORMAL if self.sensor_conn and self.actuator_conn else tk.DISABLED)
+
+    def config_if_changed(self, key, widget, **options):
+        # Skips the Tk .config() call (and its relayout) when the widget already shows these options
+        if self._prev_labels[key] != options:
+            widget.config(**options); self._prev_labels[key] = options
 
     def start_session(self):
         print("--- Session Started ---")
-        self.is_session_active = True
-        self.log_data = []
-        self.latencies_ms = []
-        with self.queue_lock: # Clear any old responses
-            self.response_queue.clear()
-        self.start_button.config(state=tk.DISABLED)
+        self._lat_n, self._lat_mean, self._lat_m2 = 0, 0.0, 0.0 # Welford running latency stats (ms)
+        self._packet_count, self._dropped_rows = 0, 0
+        self.sheet_queue = queue.Queue(maxsize=SHEET_QUEUE_MAX)
+        self._sheet_writer = threading.Thread(target=self.sheet_writer_loop, args=(self.sheet_queue,), daemon=True)
+        self._sheet_writer.start()
+        with self.pending_lock: # Drop any commands still awaiting a response
+            self.pending.clear()
+        self.is_session_active = True # Last, so the network thread never logs into a missing or stale queue
+        self.config_if_changed('start', self.start_button, state=tk.DISABLED)
         self.stop_button.config(state=tk.NORMAL)
         self.session_status_label.config(text="Session: ACTIVE", fg="green")
 
@@ -107,184 +260,270 @@ class ControlCenterApp:
         print("--- Session Stopped ---")
         self.is_session_active = False
         self.generate_final_report()
-        self.start_button.config(state=tk.NORMAL)
+        self.config_if_changed('start', self.start_button, state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
         self.session_status_label.config(text="Session: INACTIVE", fg="orange")
 
-    # (capture_camera and update_video_feed are the same as before)
+    # <<< MODIFICATION: capture_camera and update_video_feed share two preallocated frame buffers >>>
     def capture_camera(self):
         cap = cv2.VideoCapture(0)
         if not cap.isOpened(): print("❌ CRITICAL ERROR: Cannot open laptop camera."); return
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG')) # Camera-side compression, cheaper than raw YUV
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH); cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+        cap.set(cv2.CAP_PROP_FPS, CAMERA_FPS) # The camera's frame clock paces this loop
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1) # Always read the latest frame; cap.grab() blocks until it arrives
         print("✅ Camera capture thread started.")
+        last_retrieve, failed_grabs = 0.0, 0
         while not self.stop_threads.is_set():
-            ret, frame = cap.read()
+            if not cap.grab(): # Unplugged or taken by another app: grab fails immediately instead of blocking
+                failed_grabs += 1
+                if failed_grabs >= CAMERA_MAX_FAILED_GRABS: print("❌ ERROR: Laptop camera stopped delivering frames; releasing it."); break
+                time.sleep(CAMERA_RETRY_DELAY); continue
+            failed_grabs = 0
+            now = time.monotonic()
+            if now - last_retrieve < VIDEO_REFRESH_MS / 1000: continue # Grabbed but not decoded: the UI wouldn't show it
+            back = 1 - self._front
+            ret, frame = cap.retrieve(self._frame_views[back]) # Decodes in place when the size matches
             if ret:
-                with self.clients_lock: self.last_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            time.sleep(1/30)
+                last_retrieve = now
+                if frame is not self._frame_views[back]:
+                    if frame.shape[:2] != (FRAME_HEIGHT, FRAME_WIDTH): cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT), dst=self._frame_views[back])
+                    else: np.copyto(self._frame_views[back], frame)
+                self._front = back # A single attribute store, atomic under the GIL
+                self._frame_gen = next(self._frame_counter) # Published after _front so the UI never sees a stale index
         cap.release()
 
     def update_video_feed(self):
-        if self.last_frame is not None:
-            with self.clients_lock: frame_copy = self.last_frame.copy()
-            img = Image.fromarray(frame_copy); photo = ImageTk.PhotoImage(image=img)
-            self.video_label.config(image=photo); self.video_label.image = photo
-        self.master.after(33, self.update_video_feed)
+        gen = self._frame_gen
+        if gen != self._drawn_gen:
+            self._drawn_gen = gen
+            self._pil_img.frombytes(self._frame_bufs[self._front], 'raw', 'BGR') # Colour conversion and copy in one pass
+            self._photo.paste(self._pil_img)
+        self.master.after(VIDEO_REFRESH_MS, self.update_video_feed)
     
+    # <<< MODIFICATION: one selector thread serves both listeners and every agent connection >>>
     def run_network_server(self):
-        # (Same as before)
-        sensor_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM); sensor_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sensor_server.bind((LAPTOP_IP, SENSOR_AGENT_PORT)); sensor_server.listen()
-        threading.Thread(target=self.accept_connections, args=(sensor_server, self.handle_sensor_pi), daemon=True).start()
-        print(f"✅ Listening for Sensor Pi on port {SENSOR_AGENT_PORT}")
-        actuator_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM); actuator_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        actuator_server.bind((LAPTOP_IP, ACTUATOR_AGENT_PORT)); actuator_server.listen()
-        threading.Thread(target=self.accept_connections, args=(actuator_server, self.handle_actuator_pi), daemon=True).start()
-        print(f"✅ Listening for Actuator Pi on port {ACTUATOR_AGENT_PORT}")
-
-    def accept_connections(self, server_socket, handler_func):
+        sel = selectors.DefaultSelector() # epoll on Linux, kqueue on macOS
+        for port, name in [(SENSOR_AGENT_PORT, "Sensor Pi"), (ACTUATOR_AGENT_PORT, "Actuator Pi")]:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM); server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((LAPTOP_IP, port)); server.listen()
+            sel.register(server, selectors.EVENT_READ, data={'accept': name})
+            print(f"✅ Listening for {name} on port {port}")
         while not self.stop_threads.is_set():
+            for key, _ in sel.select(timeout=SELECT_TIMEOUT):
+                if key.data.get('closed'): continue # Dropped earlier in this pass (e.g. a failed send to the actuator)
+                if 'accept' in key.data: self.accept_connection(sel, key.fileobj, key.data['accept'])
+                else: self.service_connection(sel, key.fileobj, key.data)
+            self.expire_pending()
+        sel.close()
+
+    def accept_connection(self, sel, server_socket, name):
+        try:
             conn, addr = server_socket.accept()
-            print(f"Accepted connection from {addr}")
-            threading.Thread(target=handler_func, args=(conn, addr), daemon=True).start()
+        except OSError as e: print(f"❌ Accept failed for {name}: {e}"); return
+        try: tune_socket(conn)
+        except OSError as e: print(f"❌ {name} {addr} dropped during setup: {e}"); conn.close(); return
+        print(f"Accepted connection from {addr}")
+        if name == "Sensor Pi": self.sensor_conn, self.sensor_addr = conn, addr
+        else: self.actuator_conn, self.actuator_addr = conn, addr
+        # The per-connection framing buffer lives in the selector data alongside the agent's state
+        sel.register(conn, selectors.EVENT_READ, data={'name': name, 'addr': addr, 'reader': FrameReader(conn), 'identified': False, 'last_gps': None})
+        self.request_status_update()
 
-    # <<< MODIFICATION: handle_sensor_pi is now the main processing loop >>>
-    def handle_sensor_pi(self, conn, addr):
-        self.sensor_conn, self.sensor_addr = conn, addr
-        self.master.after(0, self.update_status_labels)
+    def service_connection(self, sel, conn, state):
+        # The selector reported the socket readable, so this single recv_into won't block
+        reader = state['reader']
         try:
-            intro_data = conn.recv(1024); print(f"Sensor Pi identified: {json.loads(intro_data.decode('utf-8'))}")
-            while not self.stop_threads.is_set():
-                data = conn.recv(1024)
-                if not data: break
-                if self.is_session_active and self.actuator_conn:
-                    sensor_packet = json.loads(data.decode('utf-8'))
-                    # Forward the command to the actuator
-                    command = {'voltage': sensor_packet['voltage'], 'status': sensor_packet['status']}
-                    self.actuator_conn.sendall(json.dumps(command).encode('utf-8'))
-                    
-                    # --- Start of Detailed Logging Logic ---
-                    t1 = sensor_packet['timestamp']
-                    actuator_response = None
-                    start_wait = time.time()
-                    while time.time() - start_wait < 2.0: # 2 second timeout
-                        with self.queue_lock:
-                            if self.response_queue:
-                                actuator_response = self.response_queue.popleft()
-                                break
-                        time.sleep(0.001)
-
-                    if actuator_response:
-                        t4 = time.time()
-                        t2, t3 = actuator_response['t2'], actuator_response['t3']
-                        dac_voltage_set = actuator_response.get('voltage_set', 'N/A')
-                        
-                        # Perform latency calculation
-                        offset_sec = ((t2 - t1) + (t3 - t4)) / 2
-                        corrected_t2_sec = t2 - offset_sec
-                        true_latency_sec = corrected_t2_sec - t1
-                        self.latencies_ms.append(true_latency_sec * 1000)
-
-                        # Format data for logging
-                        adc_voltage_str = f"{sensor_packet['voltage']:.4f}" if sensor_packet['status'] == "Proper" else "Junk Value"
-                        dac_voltage_str = f"{dac_voltage_set:.4f}V" if isinstance(dac_voltage_set, float) else "N/A"
-                        packet_num = len(self.log_data) + 1
-
-                        new_log_row = [
-                            packet_num,
-                            datetime.fromtimestamp(t1).strftime('%H:%M:%S:%f'),
-                            datetime.fromtimestamp(corrected_t2_sec).strftime('%H:%M:%S:%f'),
-                            f"{true_latency_sec * 1000:.2f}",
-                            adc_voltage_str,
-                            sensor_packet['status'],
-                            dac_voltage_str,
-                            str(sensor_packet['gps'])
-                        ]
-                        self.log_data.append(new_log_row)
-                        print(f"Logged Packet #{packet_num}, Delay: {true_latency_sec * 1000:.2f} ms")
-                    else:
-                        print("❌ Timed out waiting for actuator response.")
-        except (ConnectionResetError, BrokenPipeError): print(f"ℹ Sensor Pi {addr} disconnected.")
-        finally:
-            self.sensor_conn.close(); self.sensor_conn = None
-            self.master.after(0, self.update_status_labels)
-            self.master.after(0, self.stop_session)
-
-    # <<< MODIFICATION: handle_actuator_pi now just adds responses to the queue >>>
-    def handle_actuator_pi(self, conn, addr):
-        self.actuator_conn, self.actuator_addr = conn, addr
-        self.master.after(0, self.update_status_labels)
+            if not reader.fill(): return self.close_connection(sel, conn, state)
+            while True:
+                frame = reader.next_frame()
+                if frame is None: break
+                if not state['identified']:
+                    print(f"{state['name']} identified: {any_decoder.decode(frame)}")
+                    state['identified'] = True
+                elif state['name'] == "Sensor Pi": self.handle_sensor_packet(sel, sensor_decoder.decode(frame))
+                else: self.handle_actuator_status(status_decoder.decode(frame), state)
+        except (OSError, msgspec.DecodeError) as e: # Reset, keepalive timeout or a malformed frame: only this peer is dropped
+            self.close_connection(sel, conn, state, e)
+        except Exception as e: # Anything else still takes down just this connection, as its own thread used to
+            print(f"❌ Unexpected error on {state['name']} {state['addr']}: {e}")
+            self.close_connection(sel, conn, state)
+
+    def close_connection(self, sel, conn, state, reason=None):
+        print(f"ℹ {state['name']} {state['addr']} disconnected." + (f" ({reason})" if reason else ""))
+        state['closed'] = True
+        sel.unregister(conn); conn.close()
+        if conn is self.sensor_conn: self.sensor_conn = None
+        if conn is self.actuator_conn: self.actuator_conn = None
+        self.request_status_update()
+        self.master.after(0, self.stop_session)
+
+    # <<< MODIFICATION: a sensor packet forwards its command and is parked in pending until the actuator answers >>>
+    def handle_sensor_packet(self, sel, sensor_packet):
+        if not (self.is_session_active and self.actuator_conn): return
+        seq = next(self.next_seq)
+        with self.pending_lock:
+            self.pending[seq] = (sensor_packet, time.monotonic() + ACTUATOR_RESPONSE_TIMEOUT)
         try:
-            intro_data = conn.recv(1024); print(f"Actuator Pi identified: {json.loads(intro_data.decode('utf-8'))}")
-            while not self.stop_threads.is_set():
-                data = conn.recv(1024)
-                if not data: break
-                status_packet = json.loads(data.decode('utf-8'))
-                self.gps_data["actuator_pi"] = status_packet.get('gps')
-                with self.queue_lock:
-                    self.response_queue.append(status_packet)
-        except (ConnectionResetError, BrokenPipeError): print(f"ℹ Actuator Pi {addr} disconnected.")
-        finally:
-            self.actuator_conn.close(); self.actuator_conn = None
-            self.master.after(0, self.update_status_labels)
-            self.master.after(0, self.stop_session)
+            send_msg(self.actuator_conn, ActuatorCommand(voltage=sensor_packet.voltage, status=sensor_packet.status, seq=seq))
+        except OSError as e: # The actuator link failed, not the sensor connection this packet came in on
+            with self.pending_lock:
+                self.pending.pop(seq, None)
+            actuator_conn = self.actuator_conn
+            self.close_connection(sel, actuator_conn, sel.get_key(actuator_conn).data, e)
+
+    def handle_actuator_status(self, actuator_response, state):
+        gps = actuator_response.gps
+        if gps != state['last_gps']: self.gps_data["actuator_pi"] = state['last_gps'] = gps # Only cross the process boundary on change
+        with self.pending_lock:
+            waiter = self.pending.pop(actuator_response.seq, None)
+        if waiter is None or not self.is_session_active: return # Expired, or left over from a stopped session
+
+        # --- Start of Detailed Logging Logic ---
+        sensor_packet, _ = waiter
+        t1, t4 = sensor_packet.timestamp, time.time()
+        t2, t3 = actuator_response.t2, actuator_response.t3
+        dac_voltage_set = actuator_response.voltage_set
+
+        # Perform latency calculation: half the round trip minus the actuator's hold time.
+        # The hold time is taken from the actuator's monotonic clock when reported, so a
+        # wall-clock step on the Pi (e.g. NTP) can't skew it. Monotonic clocks differ between
+        # machines, so t1/t4 stay wall-clock.
+        if actuator_response.t2_mono is not None and actuator_response.t3_mono is not None:
+            hold_sec = (actuator_response.t3_mono - actuator_response.t2_mono) / 1e9
+        else:
+            hold_sec = t3 - t2
+        true_latency_sec = ((t4 - t1) - hold_sec) / 2
+        corrected_t2_sec = t1 + true_latency_sec
+        x = true_latency_sec * 1000
+        self._lat_n += 1; d = x - self._lat_mean
+        self._lat_mean += d / self._lat_n; self._lat_m2 += d * (x - self._lat_mean)
+
+        # Log raw values; format_log_row turns them into sheet cells when they are flushed
+        self._packet_count += 1; packet_num = self._packet_count
+        new_log_row = (packet_num, t1, corrected_t2_sec, true_latency_sec, sensor_packet.voltage, sensor_packet.status, dac_voltage_set, sensor_packet.gps)
+        try: self.sheet_queue.put_nowait(new_log_row) # Never block the network thread on a stalled sheet write
+        except queue.Full:
+            self._dropped_rows += 1
+            if self._dropped_rows % 100 == 1: print(f"❌ Sheet writer is behind; {self._dropped_rows} log rows dropped so far.")
+        if packet_num % 50 == 0: print(f"Logged Packet #{packet_num}, Delay: {true_latency_sec * 1000:.2f} ms")
+
+    def expire_pending(self):
+        # Commands are inserted in deadline order, so only the oldest entries need checking
+        now, expired = time.monotonic(), 0
+        with self.pending_lock:
+            while self.pending:
+                seq, (_, deadline) = next(iter(self.pending.items()))
+                if deadline > now: break
+                del self.pending[seq]; expired += 1
+        for _ in range(expired): print("❌ Timed out waiting for actuator response.")
     
     def setup_google_sheets(self):
         # (Same as before)
         try:
-            gc = gspread.service_account(filename=SERVICE_ACCOUNT_FILE); spreadsheet = gc.open(GOOGLE_SHEET_NAME)
+            gc = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
+            # Keep a small pool of HTTPS connections alive for the batched appends (gspread >= 6 holds the session on http_client)
+            getattr(gc, 'http_client', gc).session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+            spreadsheet = gc.open(GOOGLE_SHEET_NAME)
             today_sheet_name = datetime.now().strftime('%Y-%m-%d')
             try: self.worksheet = spreadsheet.worksheet(today_sheet_name)
             except gspread.exceptions.WorksheetNotFound: self.worksheet = spreadsheet.add_worksheet(title=today_sheet_name, rows="1000", cols="20")
             print(f"✅ Successfully connected to Google Spreadsheet: '{GOOGLE_SHEET_NAME}'")
         except Exception as e: print(f"❌ Google Sheets setup failed: {e}."); self.worksheet = None
             
-    # <<< MODIFICATION: generate_final_report now uses the new detailed format >>>
+    def sheet_writer_loop(self, rows_queue):
+        # Consumes one session's rows until the None sentinel, writing them every SHEET_FLUSH_INTERVAL seconds
+        # (sooner once SHEET_BATCH_ROWS rows are waiting) in calls of at most SHEET_BATCH_ROWS rows; the first
+        # call carries the run header. After a failed write the next attempt waits a full interval, and at most
+        # SHEET_QUEUE_MAX unwritten rows are held meanwhile.
+        batch, header_written, done, backing_off, dropped = [], False, False, False, 0
+        deadline = time.monotonic() + SHEET_FLUSH_INTERVAL
+        while not done:
+            try:
+                row = rows_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if row is None: done = True
+                elif len(batch) < SHEET_QUEUE_MAX: batch.append(row)
+                else: dropped += 1
+            except queue.Empty:
+                pass
+            if not (done or time.monotonic() >= deadline or (len(batch) >= SHEET_BATCH_ROWS and not backing_off)): continue
+            deadline = time.monotonic() + SHEET_FLUSH_INTERVAL
+            if not self.worksheet: batch = []; continue
+            if dropped: print(f"❌ ERROR: {dropped} log rows dropped while the Google Sheet was unavailable."); dropped = 0
+            backing_off = False
+            while batch:
+                block = [format_log_row(row) for row in batch[:SHEET_BATCH_ROWS]]
+                if not header_written:
+                    block = [[], ["--- New Test Run ---", f"Timestamp: {datetime.now().strftime('%H:%M:%S')}"], [], LOG_HEADER] + block
+                try:
+                    self.worksheet.append_rows(block, value_input_option='USER_ENTERED')
+                    del batch[:SHEET_BATCH_ROWS]; header_written = True
+                except Exception as e:
+                    print(f"❌ ERROR: Failed to write log rows to Google Sheet{'' if done else ', will retry'}. Error: {e}")
+                    backing_off = True; break
+
+    # <<< MODIFICATION: log rows are streamed to the sheet during the session; the report adds the summary >>>
     def generate_final_report(self):
-        if not self.worksheet or not self.log_data:
+        self.sheet_queue.put(None) # Sentinel: the writer flushes what is left and exits
+        self._sheet_writer.join(timeout=SHEET_WRITER_JOIN_TIMEOUT)
+        if not self.worksheet or not self._packet_count:
             print("\nNo data to log or worksheet unavailable, skipping report."); return
         print("\n--- Generating Final Report ---")
         
-        avg_latency = statistics.mean(self.latencies_ms) if self.latencies_ms else 0
-        
-        separator_block = [[], ["--- New Test Run ---", f"Timestamp: {datetime.now().strftime('%H:%M:%S')}"], []]
+        avg_latency = self._lat_mean
+        latency_std = math.sqrt(self._lat_m2 / (self._lat_n - 1)) if self._lat_n > 1 else 0
         
         summary_data = [
             ["Connection Time", datetime.now().strftime('%H:%M:%S:%f')],
             ["Connected To (Pi2)", f"{self.actuator_addr[0]}:{self.actuator_addr[1]}" if self.actuator_addr else "N/A"],
-            ["Average Commu Delay", f"{avg_latency:.2f} ms"]
+            ["Average Commu Delay", f"{avg_latency:.2f} ms"],
+            ["Commu Delay Std Dev", f"{latency_std:.2f} ms"],
+            ["Log Rows Dropped", self._dropped_rows]
         ]
         
-        header = ["Packet #", "Pi1 Send Time", "Corrected Pi2 Receive Time", "Delay (ms)", "ADC Sensor Voltage", "Data Status", "DAC Voltage Set (V)", "Sensor Pi GPS"]
-        
-        full_report_block = separator_block + summary_data + [[]] + [header] + self.log_data
-        
         try:
-            self.worksheet.append_rows(full_report_block, value_input_option='USER_ENTERED')
+            self.worksheet.append_rows([[]] + summary_data, value_input_option='USER_ENTERED')
             print(f"✅ Report successfully APPENDED to sheet '{self.worksheet.title}'!")
         except Exception as e:
             print(f"❌ ERROR: Failed to write to Google Sheet. Error: {e}")
 
-# (Flask @app.route and main function are the same as before)
-@app.route('/')
-def index():
-    control_center = app.config['CONTROL_CENTER_INSTANCE']; gps_data = control_center.gps_data
+# <<< MODIFICATION: Flask runs in a child process so map rendering never competes with the Tk/network threads >>>
+def map_key(position):
+    # ~1 m resolution: GPS jitter below that would otherwise defeat the render cache
+    return (round(position[0], 5), round(position[1], 5)) if position else None
+
+@functools.lru_cache(maxsize=MAP_CACHE_SIZE)
+def render_map(sensor_pos, actuator_pos):
     map_center, zoom_level = [20, 0], 2
-    if gps_data['sensor_pi'] and gps_data['actuator_pi']:
-        lat1, lon1 = gps_data['sensor_pi']; lat2, lon2 = gps_data['actuator_pi']
+    if sensor_pos and actuator_pos:
+        lat1, lon1 = sensor_pos; lat2, lon2 = actuator_pos
         map_center = [(lat1 + lat2) / 2, (lon1 + lon2) / 2]; zoom_level = 16
-    elif gps_data['sensor_pi']: map_center = gps_data['sensor_pi']; zoom_level = 16
-    elif gps_data['actuator_pi']: map_center = gps_data['actuator_pi']; zoom_level = 16
+    elif sensor_pos: map_center = sensor_pos; zoom_level = 16
+    elif actuator_pos: map_center = actuator_pos; zoom_level = 16
     m = folium.Map(location=map_center, zoom_start=zoom_level, tiles="OpenStreetMap")
-    if gps_data['sensor_pi']: folium.Marker(location=gps_data['sensor_pi'], popup="Sensor Pi", tooltip="Sensor Pi", icon=folium.Icon(color='red', icon='car', prefix='fa')).add_to(m)
-    if gps_data['actuator_pi']: folium.Marker(location=gps_data['actuator_pi'], popup="Actuator Pi", tooltip="Actuator Pi", icon=folium.Icon(color='blue', icon='truck', prefix='fa')).add_to(m)
-    if gps_data['sensor_pi'] and gps_data['actuator_pi']: folium.PolyLine(locations=[gps_data['sensor_pi'], gps_data['actuator_pi']], color='green', weight=5, opacity=0.8).add_to(m)
+    if sensor_pos: folium.Marker(location=sensor_pos, popup="Sensor Pi", tooltip="Sensor Pi", icon=folium.Icon(color='red', icon='car', prefix='fa')).add_to(m)
+    if actuator_pos: folium.Marker(location=actuator_pos, popup="Actuator Pi", tooltip="Actuator Pi", icon=folium.Icon(color='blue', icon='truck', prefix='fa')).add_to(m)
+    if sensor_pos and actuator_pos: folium.PolyLine(locations=[sensor_pos, actuator_pos], color='green', weight=5, opacity=0.8).add_to(m)
     return m._repr_html_()
 
+@app.route('/')
+def index():
+    gps_data = dict(shared_gps) # One IPC round trip for both positions
+    # The page only depends on the two positions, so each distinct pair is rendered once
+    return render_map(map_key(gps_data['sensor_pi']), map_key(gps_data['actuator_pi']))
+
+def run_flask(gps_data):
+    global shared_gps
+    shared_gps = gps_data
+    serve(app, host='0.0.0.0', port=5000, threads=FLASK_THREADS) # Production WSGI server instead of the Werkzeug dev server
+
 def main():
+    mgr = multiprocessing.Manager()
+    gps_data = mgr.dict(sensor_pi=None, actuator_pi=None)
+    multiprocessing.Process(target=run_flask, args=(gps_data,), daemon=True).start()
     root = tk.Tk()
     # Correcting the bug from before, ensuring __init__ is called correctly
-    app_gui = ControlCenterApp(root)
+    app_gui = ControlCenterApp(root, gps_data)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 # Guest.py (Revised to implement Task 3)
-import socket, json, time
+import socket, time, struct
+import msgspec
 import board
 import busio
 import adafruit_mcp4725
@@ -8,6 +9,68 @@ import adafruit_mcp4725
 HOST = 'pihost.local'
 PORT = 65434
 V_REF = 3.3
+SOCKET_READ_BUFFER = 65536
+
+# --- Wire Messages (must match the definitions in host_communicate.py) ---
+class HostPacket(msgspec.Struct):
+    voltage: float
+    status: str
+
+class GuestReport(msgspec.Struct):
+    t2: float
+    t3: float
+    dac_voltage_set: float
+
+# --- Socket Tuning (same settings as control_center_laptop.py) ---
+SOCKET_BUFFER_BYTES = 64 * 1024
+KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_PROBES = 5, 2, 3
+SOCKET_TIMEOUT = 10 # Seconds before a blocking socket call gives up
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, option): sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+
+# --- Message Framing (length prefix + MessagePack, as in control_center_laptop.py) ---
+msg_encoder = msgspec.msgpack.Encoder()
+packet_decoder = msgspec.msgpack.Decoder(HostPacket)
+
+def send_msg(sock, obj):
+    payload = msg_encoder.encode(obj)
+    sock.sendall(struct.pack('!I', len(payload)) + payload)
+
+class FrameReader:
+    """Blocking reader over one reusable bytearray; see control_center_laptop.py for the full notes."""
+    def __init__(self, sock, size=SOCKET_READ_BUFFER):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+
+    def read_frame(self):
+        """Returns the next payload as a memoryview (valid until the next call), or None once the peer has closed."""
+        while True:
+            available = self.end - self.start
+            if available >= 4:
+                (length,) = struct.unpack_from('!I', self.buf, self.start)
+                if available >= 4 + length:
+                    self.start += 4 + length
+                    return self.view[self.start - length:self.start]
+            if not available: self.start = self.end = 0
+            elif self.end == len(self.buf):
+                if self.start: self.buf[:available] = self.buf[self.start:self.end]
+                else:
+                    grown = bytearray(2 * len(self.buf)); grown[:available] = self.buf
+                    self.buf, self.view = grown, memoryview(grown)
+                self.start, self.end = 0, available
+            n = self.sock.recv_into(self.view[self.end:])
+            if TCP_QUICKACK is not None: self.sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+            if not n: return None
+            self.end += n
 
 # --- 2. SETUP FUNCTIONS (No changes needed here) ---
 def setup_dac():
@@ -58,35 +121,38 @@ def main():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         try:
             print(f"Connecting to host at {HOST}:{PORT}...")
+            tune_socket(s)
+            s.settimeout(SOCKET_TIMEOUT) # A stalled connect/send/recv raises instead of hanging
             s.connect((HOST, PORT))
             print("✅ Connection successful. Waiting for data...")
+            reader = FrameReader(s)
             
             while True:
-                data = s.recv(1024)
-                if not data:
+                frame = reader.read_frame()
+                if frame is None:
                     print("\nHost has closed the connection.")
                     break
                 
-                t2 = time.time()
-                received_packet = json.loads(data.decode('utf-8'))
+                t2 = time.time() # Taken before decoding, as the actuator agent does
+                received_packet = packet_decoder.decode(frame)
                 
                 # --- TASK 3 CHANGE ---
                 # Capture the voltage that was actually set on the DAC
                 voltage_set_on_dac = control_guest_vehicle_action(
-                    dac, received_packet['voltage'], received_packet['status']
+                    dac, received_packet.voltage, received_packet.status
                 )
                 
                 t3 = time.time()
                 
                 # --- TASK 3 CHANGE ---
                 # Add the actual DAC voltage to the report sent back to the host
-                report_back = {
-                    't2': t2, 
-                    't3': t3, 
-                    'dac_voltage_set': voltage_set_on_dac
-                }
+                report_back = GuestReport(
+                    t2=t2, 
+                    t3=t3, 
+                    dac_voltage_set=voltage_set_on_dac
+                )
                 
-                s.sendall(json.dumps(report_back).encode('utf-8'))
+                send_msg(s, report_back)
                 
         except ConnectionRefusedError:
             print(f"❌ ERROR: Connection refused. Is the Host script running on {HOST}?")
@@ -1,8 +1,10 @@
 # Host.py (Revised to implement Task 1, 2, and 3)
 import socket
-import json
+import struct
+import msgspec
 import time
-import statistics
+import numpy as np
+import threading
 import gspread
 from datetime import datetime
 import busio
@@ -15,6 +17,79 @@ from adafruit_mcp3xxx.analog_in import AnalogIn
 SERVICE_ACCOUNT_FILE = 'credentials.json'
 GOOGLE_SHEET_NAME = 'Pi transaction log'
 HOST, PORT = '', 65434
+SOCKET_READ_BUFFER = 65536
+ADC_POLL_INTERVAL = 0.001 # ~1 kHz background sampling
+ADC_BATCH_SAMPLES = 32 # Samples averaged into each published reading
+ADC_PROPER_FRACTION = 0.8 # Share of a batch that must read above 0.1 V for the reading to count as Proper
+
+# Latest (filtered voltage, status), replaced as a whole by adc_polling_thread
+latest_reading = (0.0, "Junk (No ADC)")
+
+# --- Wire Messages (must match the definitions in guest_communicate.py) ---
+class HostPacket(msgspec.Struct):
+    voltage: float
+    status: str
+
+class GuestReport(msgspec.Struct):
+    t2: float
+    t3: float
+    dac_voltage_set: float
+
+# --- Socket Tuning (same settings as control_center_laptop.py) ---
+SOCKET_BUFFER_BYTES = 64 * 1024
+KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_PROBES = 5, 2, 3
+SOCKET_TIMEOUT = 10 # Seconds before a blocking socket call gives up
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, option): sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+
+# --- Message Framing (length prefix + MessagePack, as in control_center_laptop.py) ---
+msg_encoder = msgspec.msgpack.Encoder()
+report_decoder = msgspec.msgpack.Decoder(GuestReport)
+
+def send_msg(sock, obj):
+    payload = msg_encoder.encode(obj)
+    sock.sendall(struct.pack('!I', len(payload)) + payload)
+
+class FrameReader:
+    """Blocking reader over one reusable bytearray; see control_center_laptop.py for the full notes."""
+    def __init__(self, sock, size=SOCKET_READ_BUFFER):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+
+    def read_frame(self):
+        """Returns the next payload as a memoryview (valid until the next call), or None once the peer has closed."""
+        while True:
+            available = self.end - self.start
+            if available >= 4:
+                (length,) = struct.unpack_from('!I', self.buf, self.start)
+                if available >= 4 + length:
+                    self.start += 4 + length
+                    return self.view[self.start - length:self.start]
+            if not available: self.start = self.end = 0
+            elif self.end == len(self.buf):
+                if self.start: self.buf[:available] = self.buf[self.start:self.end]
+                else:
+                    grown = bytearray(2 * len(self.buf)); grown[:available] = self.buf
+                    self.buf, self.view = grown, memoryview(grown)
+                self.start, self.end = 0, available
+            n = self.sock.recv_into(self.view[self.end:])
+            if TCP_QUICKACK is not None: self.sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+            if not n: return None
+            self.end += n
+
+def recv_msg(reader, decoder):
+    """Reads and decodes one framed message; returns None once the peer has closed."""
+    frame = reader.read_frame()
+    return None if frame is None else decoder.decode(frame)
 
 # --- 2. SETUP FUNCTIONS (No changes needed here) ---
 def setup_adc():
@@ -50,27 +125,43 @@ def setup_google_sheets():
         return None
 
 # --- 3. CORE LOGIC FUNCTIONS ---
+def adc_polling_thread(adc_channel):
+    """Samples the ADC in the background in batches; each batch's mean and live share become latest_reading."""
+    global latest_reading
+    samples, read_failing = np.empty(ADC_BATCH_SAMPLES, dtype=np.float32), False
+    while True:
+        try: # One handler per batch rather than per sample
+            for i in range(ADC_BATCH_SAMPLES):
+                samples[i] = adc_channel.voltage
+                time.sleep(ADC_POLL_INTERVAL)
+        except Exception as e:
+            if not read_failing: print(f"Read Error: {e}") # Once per failure streak, not every batch
+            read_failing = True
+            latest_reading = (0.0, "Junk (Read Error)")
+            time.sleep(ADC_POLL_INTERVAL)
+            continue
+        read_failing = False
+        # A few noisy samples near 0 V no longer flip the status; float() keeps numpy scalars off the wire
+        is_live = (samples > 0.1).mean() > ADC_PROPER_FRACTION
+        latest_reading = (float(samples.mean()), "Proper" if is_live else "Junk (Disconnected)")
+
 def get_sensor_reading(adc_channel):
-    """Reads voltage from the provided ADC channel and determines its status."""
+    """Returns the latest filtered voltage and its status without touching the SPI bus."""
     if not adc_channel:
         return 0.0, "Junk (No ADC)"
-    try:
-        voltage = adc_channel.voltage
-        status = "Proper" if voltage > 0.1 else "Junk (Disconnected)"
-        return voltage, status
-    except Exception as e:
-        print(f"Read Error: {e}")
-        return 0.0, "Junk (Read Error)"
+    return latest_reading
 
 def run_communication_loop(conn, adc_channel):
-    """Continuously sends sensor data and records latency."""
-    all_log_data, latencies_ms = [], []
+    """Continuously sends sensor data and records latency; returns the log rows and the average delay in ms."""
+    all_log_data = []
+    latency_sum_ms, latency_count = 0.0, 0 # Running total, so the average needs no per-packet list
     
     # --- TASK 2 CHANGE ---
     # Flag to track if we've seen a real voltage source yet.
     voltage_source_detected = False
     
     print("\n--- Waiting for voltage source on ADC... (Press Ctrl+C to stop) ---")
+    reader = FrameReader(conn)
     try:
         packet_counter = 0
         while True:
@@ -83,61 +174,67 @@ def run_communication_loop(conn, adc_channel):
                 print("\n✅ Voltage source detected! Starting real data transmission.\n")
                 voltage_source_detected = True
 
-            packet_to_send = {'voltage': sensor_voltage, 'status': sensor_status}
+            packet_to_send = HostPacket(voltage=sensor_voltage, status=sensor_status)
             t1 = time.time()
-            conn.sendall(json.dumps(packet_to_send).encode('utf-8'))
+            send_msg(conn, packet_to_send)
             print(f"-> Packet {packet_counter} sent. Status: {sensor_status}, Voltage: {sensor_voltage:.2f}V")
             
-            data_report = conn.recv(1024)
-            if not data_report:
+            pi2_data = recv_msg(reader, report_decoder)
+            if pi2_data is None:
                 print("Guest closed connection.")
                 break
             
             t4 = time.time()
-            pi2_data = json.loads(data_report.decode('utf-8'))
-            t2, t3 = pi2_data['t2'], pi2_data['t3']
+            t2, t3 = pi2_data.t2, pi2_data.t3
             
             # --- TASK 3 CHANGE ---
             # Get the reported DAC voltage from the guest's response packet.
-            dac_voltage_set = pi2_data.get('dac_voltage_set', 'N/A')
+            dac_voltage_set = pi2_data.dac_voltage_set
 
             offset_sec = ((t2 - t1) + (t3 - t4)) / 2
             corrected_t2_sec = t2 - offset_sec
             true_latency_sec = corrected_t2_sec - t1
-            latencies_ms.append(true_latency_sec * 1000)
+            latency_sum_ms += true_latency_sec * 1000
+            latency_count += 1
             
-            # --- TASK 1 CHANGE ---
-            # If the status is not "Proper", log "Junk Value" instead of the voltage number.
-            logged_sensor_voltage = f"{sensor_voltage:.4f}V" if sensor_status == "Proper" else "Junk Value"
-            logged_dac_voltage = f"{dac_voltage_set:.4f}V" if isinstance(dac_voltage_set, float) else "N/A"
-
-            all_log_data.append([
-                packet_counter,
-                datetime.fromtimestamp(t1).strftime('%H:%M:%S:%f'),
-                datetime.fromtimestamp(corrected_t2_sec).strftime('%H:%M:%S:%f'),
-                f"{true_latency_sec * 1000:.2f}",
-                logged_sensor_voltage,
-                sensor_status,
-                # --- TASK 3 CHANGE ---
-                logged_dac_voltage
-            ])
+            # Log raw values; format_log_row turns them into sheet cells when the report is written
+            all_log_data.append((packet_counter, t1, corrected_t2_sec, true_latency_sec, sensor_voltage, sensor_status, dac_voltage_set))
             time.sleep(0.5)
             
     except KeyboardInterrupt:
         print("\nStopping transmission loop.")
-    except (ConnectionResetError, BrokenPipeError):
+    except (ConnectionResetError, BrokenPipeError, TimeoutError):
         print("\nGuest connection lost.")
         
-    return all_log_data, latencies_ms
+    return all_log_data, latency_sum_ms / max(1, latency_count)
+
+def _format_clock(ts):
+    """Formats an epoch timestamp as HH:MM:SS:ffffff without building a datetime."""
+    return time.strftime('%H:%M:%S', time.localtime(ts)) + f":{int((ts % 1) * 1e6):06d}"
+
+def format_log_row(row):
+    """Turns a raw log tuple from run_communication_loop into the sheet's cell values."""
+    packet_counter, t1, corrected_t2_sec, true_latency_sec, sensor_voltage, sensor_status, dac_voltage_set = row
+    return [
+        packet_counter,
+        _format_clock(t1),
+        _format_clock(corrected_t2_sec),
+        f"{true_latency_sec * 1000:.2f}",
+        # --- TASK 1 CHANGE ---
+        # If the status is not "Proper", log "Junk Value" instead of the voltage number.
+        f"{sensor_voltage:.4f}V" if sensor_status == "Proper" else "Junk Value",
+        sensor_status,
+        # --- TASK 3 CHANGE ---
+        f"{dac_voltage_set:.4f}V" if isinstance(dac_voltage_set, float) else "N/A"
+    ]
 
-def generate_final_report(worksheet, log_data, latencies_ms, connection_details):
+def generate_final_report(worksheet, log_data, avg_latency, connection_details):
     """Appends the summary and detailed logs of the test run to the worksheet."""
     if not log_data:
         print("\nNo data was transmitted, skipping report generation.")
         return
         
     print("\n--- Generating Final Report ---")
-    avg_latency = statistics.mean(latencies_ms) if latencies_ms else 0
     
     separator_block = [[], ["--- New Test Run ---", f"Timestamp: {datetime.now().strftime('%H:%M:%S')}"], []]
     summary_data = [
@@ -151,7 +248,7 @@ def generate_final_report(worksheet, log_data, latencies_ms, connection_details)
     header = ["Packet #", "Pi1 Send Time", "Corrected Pi2 Receive Time", "Delay (ms)", 
               "ADC Sensor Voltage", "Data Status", "DAC Voltage Set (V)"]
               
-    detailed_sheet_data = [header] + log_data
+    detailed_sheet_data = [header] + [format_log_row(row) for row in log_data]
     
     full_report_block = separator_block + summary_data + [[]] + detailed_sheet_data
     
@@ -165,6 +262,7 @@ def generate_final_report(worksheet, log_data, latencies_ms, connection_details)
 def main():
     """The main function to orchestrate the entire process."""
     adc_channel = setup_adc()
+    if adc_channel: threading.Thread(target=adc_polling_thread, args=(adc_channel,), daemon=True).start()
     worksheet = setup_google_sheets()
     if not worksheet:
         print("Aborting due to Google Sheets connection failure."); return
@@ -175,15 +273,17 @@ def main():
         print("\nHost is live. Waiting for a guest to connect...")
         try:
             conn, client_address = server_socket.accept()
+            tune_socket(conn)
+            conn.settimeout(SOCKET_TIMEOUT) # A guest that stops replying raises TimeoutError instead of hanging recv
             with conn:
                 connection_details = {
                     "time": datetime.now().strftime('%H:%M:%S:%f'),
                     "addr": f"{client_address[0]}:{client_address[1]}"
                 }
                 print(f"✅ Guest connected from {client_address}")
-                collected_data, collected_latencies = run_communication_loop(conn, adc_channel)
+                collected_data, avg_latency = run_communication_loop(conn, adc_channel)
                 if collected_data:
-                    generate_final_report(worksheet, collected_data, collected_latencies, connection_details)
+                    generate_final_report(worksheet, collected_data, avg_latency, connection_details)
         except KeyboardInterrupt:
             print("\nServer stopped by user before connection.")
 
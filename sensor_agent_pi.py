@@ -1,7 +1,10 @@
 # sensor_agent_pi.py
 import socket
-import json
+import struct
+import msgspec
+from typing import Optional, Tuple
 import time
+import numpy as np
 import threading
 from gpsdclient import GPSDClient
 import busio
@@ -14,10 +17,59 @@ from adafruit_mcp3xxx.analog_in import AnalogIn
 LAPTOP_IP = "YOUR_LAPTOP_IP_ADDRESS"  # <--- IMPORTANT: SET YOUR LAPTOP's IP
 LAPTOP_PORT = 65430
 AGENT_ID = "sensor_pi"
+GPS_MIN_CHANGE_DEG = 1e-6 # Smaller lat/lon movements are not republished
+ADC_POLL_INTERVAL = 0.001 # ~1 kHz background sampling
+ADC_BATCH_SAMPLES = 32 # Samples averaged into each published reading
+ADC_PROPER_FRACTION = 0.8 # Share of a batch that must read above 0.1 V for the reading to count as Proper
 
 # --- Global State ---
 latest_gps_coords = None
 adc_channel = None
+latest_reading = (0.0, "Junk (No ADC)") # (filtered voltage, status), replaced as a whole by adc_polling_thread
+
+# --- Wire Messages (must match the definition in control_center_laptop.py) ---
+class SensorPacket(msgspec.Struct, array_like=True): # Fixed schema: sent as a positional array, no field names on the wire
+    voltage: float
+    status: str
+    gps: Optional[Tuple[float, float]]
+    timestamp: float
+
+# --- GPSD Reports ---
+class Tpv(msgspec.Struct): # Only the fields we read; the rest of each gpsd report is skipped while decoding
+    class_: str = msgspec.field(default='', name='class')
+    mode: int = 0
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+tpv_decoder = msgspec.json.Decoder(Tpv)
+
+# --- Socket Tuning (same settings as control_center_laptop.py) ---
+SOCKET_BUFFER_BYTES = 64 * 1024
+KEEPALIVE_IDLE, KEEPALIVE_INTERVAL, KEEPALIVE_PROBES = 5, 2, 3
+SOCKET_TIMEOUT = 10 # Seconds before a blocking socket call gives up
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, option): sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+
+# --- Message Framing (length prefix + MessagePack, as in control_center_laptop.py) ---
+msg_encoder = msgspec.msgpack.Encoder()
+send_buf = bytearray(64) # Reused frame buffer: prefix at [0:4], payload encoded in place after it
+
+def send_msg(sock, obj):
+    msg_encoder.encode_into(obj, send_buf, 4)
+    struct.pack_into('!I', send_buf, 0, len(send_buf) - 4)
+    sock.sendall(send_buf)
+
+def frame_msg(obj):
+    payload = msg_encoder.encode(obj)
+    return struct.pack('!I', len(payload)) + payload
+
+INTRO_BYTES = frame_msg({'id': AGENT_ID}) # Identical on every reconnect, so framed once
 
 def setup_adc():
     global adc_channel
@@ -31,61 +83,78 @@ def setup_adc():
         print(f"❌ ERROR: Could not initialize ADC: {e}")
         adc_channel = None
 
-def get_sensor_reading():
-    if not adc_channel:
-        return 0.0, "Junk (No ADC)"
-    try:
-        voltage = adc_channel.voltage
-        status = "Proper" if voltage > 0.1 else "Junk (Disconnected)"
-        return voltage, status
-    except Exception as e:
-        print(f"ADC Read Error: {e}")
-        return 0.0, "Junk (Read Error)"
+def adc_polling_thread():
+    # Samples the ADC off the send path in batches; each batch's mean and live share become latest_reading
+    global latest_reading
+    samples, read_failing = np.empty(ADC_BATCH_SAMPLES, dtype=np.float32), False
+    while True:
+        try: # One handler per batch rather than per sample
+            for i in range(ADC_BATCH_SAMPLES):
+                samples[i] = adc_channel.voltage
+                time.sleep(ADC_POLL_INTERVAL)
+        except Exception as e:
+            if not read_failing: print(f"ADC Read Error: {e}") # Once per failure streak, not every batch
+            read_failing = True
+            latest_reading = (0.0, "Junk (Read Error)")
+            time.sleep(ADC_POLL_INTERVAL)
+            continue
+        read_failing = False
+        # A few noisy samples near 0 V no longer flip the status; float() keeps numpy scalars off the wire
+        is_live = (samples > 0.1).mean() > ADC_PROPER_FRACTION
+        latest_reading = (float(samples.mean()), "Proper" if is_live else "Junk (Disconnected)")
 
-def get_gps_coords():
-    try:
-        with GPSDClient() as client:
-            for result_str in client.json_stream():
-                result = json.loads(result_str)
-                if result.get("class") == "TPV" and result.get("mode") == 3 and "lat" in result:
-                    coords = (result['lat'], result['lon'])
-                    print(f"🛰  Sensor Pi GPS Lock: {coords}")
-                    return coords
-    except Exception as e:
-        print(f"❌ GPSD Error on Sensor Pi: {e}")
-        return None
+def get_sensor_reading():
+    return latest_reading
 
 def gps_polling_thread():
+    # Keeps one gpsd connection open and only publishes a fix when the position actually moves
     global latest_gps_coords
     while True:
-        latest_gps_coords = get_gps_coords()
-        time.sleep(3)
+        try:
+            with GPSDClient() as client:
+                last_raw_str = None
+                for result_str in client.json_stream():
+                    if result_str == last_raw_str: continue # Identical report, nothing new to parse
+                    last_raw_str = result_str
+                    try: tpv = tpv_decoder.decode(result_str)
+                    except msgspec.DecodeError: continue # A report whose fields don't fit Tpv isn't a fix
+                    if tpv.class_ == "TPV" and tpv.mode == 3 and tpv.lat is not None and tpv.lon is not None:
+                        coords = (tpv.lat, tpv.lon)
+                        if (latest_gps_coords is None or abs(coords[0] - latest_gps_coords[0]) > GPS_MIN_CHANGE_DEG
+                                or abs(coords[1] - latest_gps_coords[1]) > GPS_MIN_CHANGE_DEG):
+                            latest_gps_coords = coords
+                            print(f"🛰  Sensor Pi GPS Lock: {coords}")
+        except Exception as e:
+            print(f"❌ GPSD Error on Sensor Pi: {e}")
+            latest_gps_coords = None
+        time.sleep(3) # Back off before reconnecting to gpsd
 
 def main():
     print(f"--- Starting Sensor Agent ({AGENT_ID}) ---")
     setup_adc()
+    if adc_channel: threading.Thread(target=adc_polling_thread, daemon=True).start()
     threading.Thread(target=gps_polling_thread, daemon=True).start()
 
     while True:
         try:
             print(f"Attempting to connect to Control Center at {LAPTOP_IP}:{LAPTOP_PORT}...")
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                tune_socket(s)
+                s.settimeout(SOCKET_TIMEOUT) # A stalled connect/send/recv raises instead of hanging
                 s.connect((LAPTOP_IP, LAPTOP_PORT))
                 print("✅ Connected to Control Center.")
                 
-                intro_message = json.dumps({'id': AGENT_ID}).encode('utf-8')
-                s.sendall(intro_message)
+                s.sendall(INTRO_BYTES)
 
                 while True:
                     voltage, status = get_sensor_reading()
-                    packet = {
-                        'type': 'sensor_data',
-                        'voltage': voltage,
-                        'status': status,
-                        'gps': latest_gps_coords,
-                        'timestamp': time.time()
-                    }
-                    s.sendall(json.dumps(packet).encode('utf-8'))
+                    packet = SensorPacket(
+                        voltage=voltage,
+                        status=status,
+                        gps=latest_gps_coords,
+                        timestamp=time.time()
+                    )
+                    send_msg(s, packet)
                     print(f"-> Sent: Voltage={voltage:.2f}V, Status={status}, GPS={latest_gps_coords}")
                     time.sleep(0.5)
 
@@ -96,5 +165,5 @@ def main():
         
         time.sleep(5)
 
-if _name_ == "_main_":
+if __name__ == "__main__":
     main()